@@ -6,18 +6,30 @@
 # - Improved timeout handling
 
 import os
+import re
 import time
 import asyncio
+import hashlib
+import json
 import logging
+import tempfile
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Dict, Optional, List, Literal, Tuple
+from types import MappingProxyType
+from typing import Awaitable, Dict, Mapping, Optional, Literal, Set, Tuple, Union
 from threading import Thread
 
+import aiohttp
 import discord
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:  # Not available on Windows; fall back to the stock asyncio loop
+    uvloop = None
+
 # HTTP server for health checks
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
@@ -43,7 +55,7 @@ class HealthCheckHandler(BaseHTTPRequestHandler):
 def run_health_server(port=8080):
     """Run a simple HTTP server for health checks"""
     server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-    logging.info(f"Health check server running on port {port}")
+    logging.info("Health check server running on port %s", port)
     server.serve_forever()
 
 # ============================== ENV & CONFIG ==============================
@@ -53,10 +65,11 @@ TOKEN = os.getenv("DISCORD_BOT_TOKEN") or os.getenv("DISCORD_TOKEN")
 if not TOKEN:
     raise RuntimeError("Set DISCORD_BOT_TOKEN (or DISCORD_TOKEN) in your environment.")
 
-GUILD_IDS = os.getenv("GUILD_IDS", "")
+GUILD_IDS: Tuple[int, ...] = tuple(int(x) for x in os.getenv("GUILD_IDS", "").split(",") if x.strip().isdigit())
 TEMP_VC_CATEGORY_ID = int(os.getenv("TEMP_VC_CATEGORY_ID", "0"))
 HITTERS_ROLE_NAME = os.getenv("HITTERS_ROLE_NAME", "hitters")
 DELETE_VC_IF_EMPTY_AFTER_SECS = int(os.getenv("DELETE_VC_IF_EMPTY_AFTER_SECS", "300"))
+MAX_TRACKED_RALLIES = int(os.getenv("MAX_TRACKED_RALLIES", "1024"))
 
 ENABLE_VOICE = os.getenv("ENABLE_VOICE", "false").strip().lower() in ("1", "true", "yes")
 
@@ -66,6 +79,9 @@ VOICE_IDLE_TIMEOUT_SECS = int(os.getenv("VOICE_IDLE_TIMEOUT_SECS", "1800"))
 RTC_REGION_FOR_TEMP_VC = os.getenv("RTC_REGION_FOR_TEMP_VC", "").strip()
 FORCE_RTC_REGION = os.getenv("FORCE_RTC_REGION", "").strip()
 
+# Fingerprint of the last successfully synced command tree; delete the file to force a resync
+COMMAND_SYNC_HASH_PATH = os.getenv("COMMAND_SYNC_HASH_PATH", os.path.expanduser("~/.rallybot_sync_hash"))
+
 # Health check port (Render uses PORT env var)
 HEALTH_PORT = int(os.getenv("PORT", "8080"))
 
@@ -82,8 +98,20 @@ AUDIO_15S_ROLL = os.getenv("AUDIO_15S_ROLL", "https://storage.googleapis.com/ral
 AUDIO_30S_ROLL = os.getenv("AUDIO_30S_ROLL", "https://storage.googleapis.com/rallybot/30secondgaps.mp3")
 AUDIO_EXPLAIN_ROLL = os.getenv("AUDIO_EXPLAIN_ROLL", "https://storage.googleapis.com/rallybot/explainrollingrallies.mp3")
 
-def _parse_guild_ids() -> List[int]:
-    return [int(x) for x in GUILD_IDS.split(",") if x.strip().isdigit()]
+# Local copies of the countdown clips are kept here (see prefetch_audio). Files are named by
+# the URL's SHA-1 and never re-validated, so a clip replaced at the same URL is only picked
+# up after clearing this directory
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "rallybot"))
+# Per-clip download limit, so a stalled CDN can't hold the startup prefetch open
+AUDIO_PREFETCH_TIMEOUT_SECS = 60.0
+
+# Countdown clips keyed by the /type_of_rally choice values
+BOMB_AUDIO: Mapping[str, str] = MappingProxyType(
+    {"5m": AUDIO_5M_BOMB, "10m": AUDIO_10M_BOMB, "30m": AUDIO_30M_BOMB, "1h": AUDIO_1H_BOMB}
+)
+ROLLING_AUDIO: Mapping[str, str] = MappingProxyType(
+    {"5s": AUDIO_5S_ROLL, "10s": AUDIO_10S_ROLL, "15s": AUDIO_15S_ROLL, "30s": AUDIO_30S_ROLL}
+)
 
 # ============================== LOGGING & BOT ==============================
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
@@ -104,11 +132,22 @@ bot = commands.Bot(
 )
 tree = bot.tree
 
+# The loop only keeps weak references to tasks; fire-and-forget work is pinned here until it finishes
+_BG_TASKS: Set[asyncio.Task] = set()
+
+def _spawn(coro: Awaitable) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+    return task
+
 # ============================== DATA MODELS ==============================
 TroopType = Literal["Cavalry", "Infantry", "Range"]
 TroopTier = Literal["T8", "T9", "T10", "T11", "T12"]
 
-@dataclass
+_YES_ANSWERS = frozenset(("yes", "y", "true", "1"))
+
+@dataclass(slots=True)
 class Participant:
     user_id: int
     troop_type: TroopType
@@ -116,7 +155,10 @@ class Participant:
     rally_dragon: bool
     capacity_value: int
 
-@dataclass
+# Troop details recorded for a rally creator until they fill the join form
+_DEFAULT_PARTICIPANT_TEMPLATE = ("Cavalry", "T10", False, 0)
+
+@dataclass(slots=True)
 class Rally:
     message_id: int
     guild_id: int
@@ -135,16 +177,63 @@ class Rally:
 
     participants: Dict[int, Participant] = field(default_factory=dict)
 
+    # The posted rally message, kept so edits don't need to fetch it first
+    message_ref: Optional[Union[discord.Message, discord.PartialMessage]] = field(default=None, repr=False, compare=False)
+    # Set once an edit finds the post gone; the temp VC is still cleaned up through RALLY_BY_VC
+    _post_deleted: bool = field(default=False, init=False, repr=False, compare=False)
+    # Last rendered embed/view; after creation only the roster field and the Join VC link change
+    _embed_cache: Optional[discord.Embed] = field(default=None, init=False, repr=False, compare=False)
+    _view_cache: Optional[discord.ui.View] = field(default=None, init=False, repr=False, compare=False)
+    # Serializes edits of the rally post so a slow edit can't land after a newer one
+    _edit_lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False, repr=False, compare=False)
+
+    # Joined roster mentions, extended in place on join; None after a leave until the next rebuild
+    _roster_str: Optional[str] = field(default="", init=False, repr=False, compare=False)
+
+    def add_participant(self, p: Participant):
+        if p.user_id not in self.participants and self._roster_str is not None:
+            mention = f"<@{p.user_id}>"
+            self._roster_str = f"{self._roster_str}, {mention}" if self._roster_str else mention
+        self.participants[p.user_id] = p
+
+    def remove_participant(self, user_id: int):
+        del self.participants[user_id]
+        self._roster_str = None
+
     def roster_mentions(self) -> str:
         if not self.participants:
             return "—"
-        return ", ".join(f"<@{uid}>" for uid in self.participants.keys())
-
-RALLIES: Dict[int, Rally] = {}
-VC_TO_POST: Dict[int, int] = {}
+        if self._roster_str is None:
+            self._roster_str = ", ".join(f"<@{uid}>" for uid in self.participants.keys())
+        return self._roster_str
+
+# Rally posts by message id, least recently used first; capped at MAX_TRACKED_RALLIES
+RALLIES: "OrderedDict[int, Rally]" = OrderedDict()
+RALLY_BY_VC: Dict[int, Rally] = {}
+# Non-bot members currently in each tracked temp VC, kept up to date by on_voice_state_update
+VC_NONBOT_COUNT: Dict[int, int] = {}
+
+def vc_is_empty(vc_id: int) -> bool:
+    return VC_NONBOT_COUNT.get(vc_id) == 0
+
+def get_rally(message_id: int) -> Optional[Rally]:
+    r = RALLIES.get(message_id)
+    if r is not None:
+        RALLIES.move_to_end(message_id)
+    return r
+
+def track_rally(r: Rally, vc: discord.VoiceChannel):
+    RALLIES[r.message_id] = r
+    RALLY_BY_VC[vc.id] = r
+    VC_NONBOT_COUNT[vc.id] = sum(1 for m in vc.members if not m.bot)
+    # Evicted rallies stop answering their buttons; a live temp VC is still
+    # cleaned up through RALLY_BY_VC
+    while len(RALLIES) > MAX_TRACKED_RALLIES:
+        mid, _ = RALLIES.popitem(last=False)
+        log.info("Forgetting rally %s (tracking limit reached)", mid)
 
 # ============================== VOICE STATE ==============================
-@dataclass
+@dataclass(slots=True)
 class GuildVoiceState:
     last_activity: float = field(default_factory=time.time)
     disconnect_task: Optional[asyncio.Task] = None
@@ -152,10 +241,18 @@ class GuildVoiceState:
 
 VOICE_STATE: Dict[int, GuildVoiceState] = {}
 
+def _voice_state(guild_id: int) -> GuildVoiceState:
+    state = VOICE_STATE.get(guild_id)
+    if state is None:
+        state = VOICE_STATE[guild_id] = GuildVoiceState()
+    return state
+
 def _reset_activity(guild_id: int):
     if guild_id in VOICE_STATE:
         VOICE_STATE[guild_id].last_activity = time.time()
 
+VOICE_CONNECT_TIMEOUT_SECS = 10.0
+
 async def _ensure_voice_ready(member: discord.Member) -> Tuple[Optional[discord.VoiceClient], Optional[str]]:
     """Connect to voice or return existing connection"""
     guild = member.guild
@@ -172,40 +269,102 @@ async def _ensure_voice_ready(member: discord.Member) -> Tuple[Optional[discord.
         
         # Move to new channel
         try:
-            await guild.voice_client.move_to(target_channel)
-            log.info(f"Moved to {target_channel.name}")
-            return guild.voice_client, None
+            await guild.voice_client.move_to(target_channel, timeout=VOICE_CONNECT_TIMEOUT_SECS)
+            # discord.py only logs a timed-out move, so check where we actually ended up
+            vc = guild.voice_client
+            if vc and vc.channel and vc.channel.id == target_channel.id:
+                log.info("Moved to %s", target_channel.name)
+                return vc, None
+            log.warning("Move to %s did not complete", target_channel.name)
         except Exception as e:
-            log.error(f"Failed to move to channel: {e}")
-            # Try disconnect and reconnect
-            try:
-                await guild.voice_client.disconnect(force=True)
-            except:
-                pass
+            log.error("Failed to move to channel: %s", e)
+        # Try disconnect and reconnect
+        try:
+            await guild.voice_client.disconnect(force=True)
+        except:
+            pass
     
     # Connect to channel
     try:
-        voice_client = await target_channel.connect(timeout=10.0, reconnect=True)
-        log.info(f"Connected to {target_channel.name}")
+        voice_client = await target_channel.connect(timeout=VOICE_CONNECT_TIMEOUT_SECS, reconnect=True)
+        log.info("Connected to %s", target_channel.name)
         return voice_client, None
     except asyncio.TimeoutError:
         return None, "Connection timeout - try again"
     except Exception as e:
-        log.error(f"Voice connection failed: {e}")
+        log.error("Voice connection failed: %s", e)
         return None, f"Connection failed: {str(e)[:100]}"
 
-async def _play_audio_url(voice: discord.VoiceClient, url: str, volume: float = 1.0):
-    """Play audio from URL with better error handling"""
+_FFMPEG_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+_FFMPEG_OPTIONS = '-vn -af "loudnorm=I=-16:TP=-1.5:LRA=11"'
+_FFMPEG_KW = {'before_options': _FFMPEG_BEFORE_OPTIONS, 'options': _FFMPEG_OPTIONS}
+
+# Clip URL -> downloaded copy on disk; URLs missing here are streamed by ffmpeg
+AUDIO_PATHS: Dict[str, str] = {}
+
+def _write_file(path: str, data: bytes):
+    # Written beside the target and renamed, so an interrupted download never looks cached
+    with open(path + ".part", "wb") as f:
+        f.write(data)
+    os.replace(path + ".part", path)
+
+async def _prefetch_clip(session: aiohttp.ClientSession, url: str):
+    path = os.path.join(AUDIO_CACHE_DIR, hashlib.sha1(url.encode()).hexdigest())
+    if not await asyncio.to_thread(os.path.exists, path):
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                data = await resp.read()
+            await asyncio.to_thread(_write_file, path, data)
+        except Exception as e:
+            log.warning("Could not cache audio %s: %s", url, e)
+            return
+    AUDIO_PATHS[url] = path
+
+async def prefetch_audio():
+    """Download the countdown clips once so playback doesn't re-fetch them over HTTPS"""
+    urls = {u for u in (*BOMB_AUDIO.values(), *ROLLING_AUDIO.values()) if u}
+    await asyncio.to_thread(os.makedirs, AUDIO_CACHE_DIR, exist_ok=True)
+    timeout = aiohttp.ClientTimeout(total=AUDIO_PREFETCH_TIMEOUT_SECS)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        await asyncio.gather(*(_prefetch_clip(session, url) for url in urls))
+    log.info("Cached %d/%d audio clips in %s", len(AUDIO_PATHS), len(urls), AUDIO_CACHE_DIR)
+
+def _open_audio(url: str) -> discord.FFmpegOpusAudio:
+    """Spawn ffmpeg for a clip, preferring the prefetched copy"""
+    # loudnorm forces a re-encode anyway, so have ffmpeg emit Opus rather than PCM that
+    # discord.py would otherwise encode in-process
+    local = AUDIO_PATHS.get(url)
+    if local:
+        # The reconnect flags only apply to network inputs
+        return discord.FFmpegOpusAudio(local, options=_FFMPEG_OPTIONS)
+    return discord.FFmpegOpusAudio(url, **_FFMPEG_KW)
+
+async def _connect_with_audio(
+    member: discord.Member, url: str
+) -> Tuple[Optional[discord.VoiceClient], Optional[discord.FFmpegOpusAudio], Optional[str]]:
+    """Join the member's VC while ffmpeg starts up, so playback can begin right after the handshake"""
+    opening = asyncio.create_task(asyncio.to_thread(_open_audio, url))
+    voice, err = await _ensure_voice_ready(member)
+    try:
+        source = await opening
+    except Exception as e:
+        log.error("Audio source error: %s", e)
+        if voice:
+            # Nothing will play, so don't sit in the channel until the idle timeout
+            _schedule_auto_disconnect(member.guild.id)
+        return voice, None, f"Playback failed: {e}"
+    if not voice:
+        source.cleanup()
+        return None, None, f"Failed to connect: {err}"
+    return voice, source, None
+
+async def _play_audio(voice: discord.VoiceClient, source: discord.AudioSource):
+    """Play an opened audio source with better error handling"""
     if voice.is_playing():
         voice.stop()
     
     try:
-        ffmpeg_opts = {
-            'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-            'options': '-vn -af "loudnorm=I=-16:TP=-1.5:LRA=11"'
-        }
-        
-        source = discord.FFmpegPCMAudio(url, **ffmpeg_opts)
         voice.play(source)
         
         # Wait for playback to finish
@@ -213,7 +372,8 @@ async def _play_audio_url(voice: discord.VoiceClient, url: str, volume: float =
             await asyncio.sleep(0.5)
             
     except Exception as e:
-        log.error(f"Audio playback error: {e}")
+        log.error("Audio playback error: %s", e)
+        source.cleanup()
         raise
 
 async def schedule_disconnect(guild_id: int, delay_secs: int):
@@ -235,12 +395,33 @@ async def schedule_disconnect(guild_id: int, delay_secs: int):
         if guild_id in VOICE_STATE:
             del VOICE_STATE[guild_id]
     except Exception as e:
-        log.error(f"Error during auto-disconnect: {e}")
+        log.error("Error during auto-disconnect: %s", e)
+
+def _schedule_auto_disconnect(guild_id: int):
+    """(Re)start the post-playback disconnect countdown for a guild"""
+    state = _voice_state(guild_id)
+    if state.disconnect_task and not state.disconnect_task.done():
+        state.disconnect_task.cancel()
+    state.disconnect_task = _spawn(schedule_disconnect(guild_id, DISCONNECT_AFTER_PLAY_SECS))
 
 # ============================== UTILITIES ==============================
+# (guild_id, casefolded role name) -> role id, or None when the guild has no such role
+_ROLE_ID_CACHE: Dict[Tuple[int, str], Optional[int]] = {}
+
 def role_mention(guild: discord.Guild, role_name: str) -> str:
-    r = discord.utils.find(lambda rr: rr.name.lower() == role_name.lower(), guild.roles)
-    return r.mention if r else f"@{role_name}"
+    key = (guild.id, role_name.casefold())
+    try:
+        rid = _ROLE_ID_CACHE[key]
+    except KeyError:
+        rid = next((rr.id for rr in guild.roles if rr.name.casefold() == key[1]), None)
+        _ROLE_ID_CACHE[key] = rid
+    return f"<@&{rid}>" if rid else f"@{role_name}"
+
+def forget_guild_roles(guild_id: int):
+    for key in [k for k in _ROLE_ID_CACHE if k[0] == guild_id]:
+        del _ROLE_ID_CACHE[key]
+
+_CTA_MENTIONS = discord.AllowedMentions(everyone=False, users=False, roles=True)
 
 def rally_cta_text(guild: discord.Guild) -> Tuple[str, discord.AllowedMentions]:
     text = (
@@ -248,12 +429,13 @@ def rally_cta_text(guild: discord.Guild) -> Tuple[str, discord.AllowedMentions]:
         "Click **Join Rally**, fill the form, and you're in.\n"
         "Then use `/type_of_rally rolling` or `/type_of_rally bomb` to run the countdown in VC."
     )
-    mentions = discord.AllowedMentions(everyone=False, users=False, roles=True)
-    return text, mentions
+    return text, _CTA_MENTIONS
+
+_NON_DIGITS_RE = re.compile(r"\D+")
 
 def ensure_int(value: str, default: int = 0) -> int:
     try:
-        return int("".join(ch for ch in value if ch.isdigit()))
+        return int(_NON_DIGITS_RE.sub("", value) or default)
     except Exception:
         return default
 
@@ -272,6 +454,10 @@ async def pick_or_create_category(
         return owner.voice.channel.category
     return await guild.create_category("Rallies", reason="Rally temp VC category")
 
+# @everyone/bot overwrites per guild; only the owner entry differs between temp VCs
+_BASE_OVERWRITES: Dict[int, Dict[Union[discord.Role, discord.Member], discord.PermissionOverwrite]] = {}
+_OWNER_OVERWRITE = discord.PermissionOverwrite(view_channel=True, connect=True, speak=True, manage_channels=True)
+
 async def ensure_temp_vc(
     guild: discord.Guild,
     owner: discord.Member,
@@ -281,13 +467,15 @@ async def ensure_temp_vc(
 ) -> discord.VoiceChannel:
     cat = await pick_or_create_category(guild, context_channel, owner)
 
-    overwrites = {
-        guild.default_role: discord.PermissionOverwrite(view_channel=True, connect=True),
-        guild.me: discord.PermissionOverwrite(
-            view_channel=True, connect=True, speak=True, move_members=True, manage_channels=True
-        ),
-        owner: discord.PermissionOverwrite(view_channel=True, connect=True, speak=True, manage_channels=True),
-    }
+    base = _BASE_OVERWRITES.get(guild.id)
+    if base is None:
+        base = _BASE_OVERWRITES[guild.id] = {
+            guild.default_role: discord.PermissionOverwrite(view_channel=True, connect=True),
+            guild.me: discord.PermissionOverwrite(
+                view_channel=True, connect=True, speak=True, move_members=True, manage_channels=True
+            ),
+        }
+    overwrites = {**base, owner: _OWNER_OVERWRITE}
 
     owner_region = None
     if owner.voice and isinstance(owner.voice.channel, discord.VoiceChannel):
@@ -311,71 +499,112 @@ async def ensure_temp_vc(
 
     return vc
 
-async def create_or_refresh_vc_invite(vc: discord.VoiceChannel) -> str:
-    invite = await vc.create_invite(max_age=0, max_uses=0, unique=True, reason="Rally VC button")
+# Rally creation waits on this; past the deadline the post just goes out without a Join VC button
+INVITE_TIMEOUT_SECS = 5.0
+
+async def create_or_refresh_vc_invite(vc: discord.VoiceChannel) -> Optional[str]:
+    try:
+        invite = await asyncio.wait_for(
+            vc.create_invite(max_age=0, max_uses=0, unique=True, reason="Rally VC button"),
+            timeout=INVITE_TIMEOUT_SECS,
+        )
+    except (asyncio.TimeoutError, discord.HTTPException) as e:
+        log.warning("Could not create invite for temp VC %s: %r", vc.name, e)
+        return None
     return invite.url
 
+_KEEP_EMBED_COLOR = discord.Color.red().value
+_SOP_EMBED_COLOR = discord.Color.gold().value
+
+def _roster_field(r: Rally) -> dict:
+    roster = r.roster_mentions()
+    if len(roster) > 1024:
+        roster = roster[:1020] + "..."
+    return {"name": f"Roster ({len(r.participants)})", "value": roster, "inline": False}
+
 def embed_for_rally(guild: discord.Guild, r: Rally) -> discord.Embed:
+    emb = r._embed_cache
+    if emb is not None:
+        # The roster is always the last field
+        emb.set_field_at(len(emb.fields) - 1, **_roster_field(r))
+        return emb
+
+    # Built as one dict so the whole field list is handed to discord.py in a single pass
     if r.rally_kind == "KEEP":
-        title_text = f"🏰 Keep Rally (L{r.keep_level or '??'})"
-        emb = discord.Embed(title=title_text, color=discord.Color.red())
-        emb.add_field(name="Power", value=r.keep_power or "??", inline=True)
-        emb.add_field(name="Primary Troop", value=r.primary_troop or "??", inline=True)
-        emb.add_field(name="Gear Worn", value=r.gear_worn or "??", inline=True)
-        emb.add_field(name="Idle & Scouted?", value=r.idle_and_scouted or "??", inline=True)
+        data = {
+            "title": f"🏰 Keep Rally (L{r.keep_level or '??'})",
+            "color": _KEEP_EMBED_COLOR,
+            "fields": [
+                {"name": "Power", "value": r.keep_power or "??", "inline": True},
+                {"name": "Primary Troop", "value": r.primary_troop or "??", "inline": True},
+                {"name": "Gear Worn", "value": r.gear_worn or "??", "inline": True},
+                {"name": "Idle & Scouted?", "value": r.idle_and_scouted or "??", "inline": True},
+            ],
+        }
     else:
-        title_text = "👑 SOP Rally"
-        emb = discord.Embed(title=title_text, color=discord.Color.gold())
+        data = {"title": "👑 SOP Rally", "color": _SOP_EMBED_COLOR, "fields": []}
 
     owner = guild.get_member(r.creator_id)
     if owner:
-        emb.set_author(name=f"Rally Lead: {owner.display_name}", icon_url=owner.display_avatar.url)
+        data["author"] = {"name": f"Rally Lead: {owner.display_name}", "icon_url": owner.display_avatar.url}
 
-    if r.participants:
-        roster = r.roster_mentions()
-        if len(roster) > 1024:
-            roster = roster[:1020] + "..."
-        emb.add_field(name=f"Roster ({len(r.participants)})", value=roster, inline=False)
-    else:
-        emb.add_field(name="Roster (0)", value="—", inline=False)
+    data["fields"].append(_roster_field(r))
 
+    emb = r._embed_cache = discord.Embed.from_dict(data)
     return emb
 
+# Roster changes within this window are folded into a single edit of the rally post
+UPDATE_POST_DEBOUNCE_SECS = 0.5
+_PENDING_UPDATES: Dict[int, asyncio.Task] = {}
+
 async def update_post(guild: discord.Guild, r: Rally):
+    if not r._post_deleted and r.message_id not in _PENDING_UPDATES:
+        _PENDING_UPDATES[r.message_id] = _spawn(_delayed_update(guild, r))
+
+async def _delayed_update(guild: discord.Guild, r: Rally):
+    await asyncio.sleep(UPDATE_POST_DEBOUNCE_SECS)
+    # Drop the marker before editing so changes made during the edit schedule another one
+    _PENDING_UPDATES.pop(r.message_id, None)
     try:
-        ch = guild.get_channel(r.channel_id)
-        if isinstance(ch, discord.TextChannel):
-            msg = await ch.fetch_message(r.message_id)
+        msg = r.message_ref
+        if msg is None:
+            ch = guild.get_channel(r.channel_id)
+            if not isinstance(ch, discord.TextChannel):
+                return
+            msg = r.message_ref = ch.get_partial_message(r.message_id)
+        async with r._edit_lock:
             await msg.edit(embed=embed_for_rally(guild, r), view=build_rally_view(r))
+    except discord.NotFound:
+        log.info("Rally post %s was deleted; forgetting the rally", r.message_id)
+        r._post_deleted = True
+        RALLIES.pop(r.message_id, None)
     except Exception as e:
         log.warning("Failed to update rally post %s: %s", r.message_id, e)
 
 def build_rally_view(r: Rally) -> discord.ui.View:
-    view = discord.ui.View(timeout=None)
-    view.add_item(JoinButton(r.message_id))
-    view.add_item(LeaveButton(r.message_id))
-    if r.temp_vc_invite_url:
-        view.add_item(discord.ui.Button(label="Join VC", url=r.temp_vc_invite_url, style=discord.ButtonStyle.link))
+    view = r._view_cache
+    if view is None:
+        view = r._view_cache = RallyView(r)
     return view
 
 # ... [Rest of the code continues with UI components, commands, etc.]
 # I'll include the essential parts and note where to add the rest
 
+# Rally buttons look the rally up from the message they are attached to, so the
+# post can be sent with its final view before its message id is known
 class JoinButton(discord.ui.Button):
-    def __init__(self, rally_id: int):
-        super().__init__(label="Join Rally", style=discord.ButtonStyle.green, custom_id=f"join_{rally_id}")
-        self.rally_id = rally_id
+    def __init__(self):
+        super().__init__(label="Join Rally", style=discord.ButtonStyle.green, custom_id="rally_join")
 
     async def callback(self, interaction: discord.Interaction):
-        await interaction.response.send_modal(JoinRallyModal(self.rally_id))
+        await interaction.response.send_modal(JoinRallyModal(interaction.message.id))
 
 class LeaveButton(discord.ui.Button):
-    def __init__(self, rally_id: int):
-        super().__init__(label="Leave Rally", style=discord.ButtonStyle.red, custom_id=f"leave_{rally_id}")
-        self.rally_id = rally_id
+    def __init__(self):
+        super().__init__(label="Leave Rally", style=discord.ButtonStyle.red, custom_id="rally_leave")
 
     async def callback(self, interaction: discord.Interaction):
-        r = RALLIES.get(self.rally_id)
+        r = get_rally(interaction.message.id)
         if not r:
             return await interaction.response.send_message("Rally not found.", ephemeral=True)
         
@@ -383,9 +612,18 @@ class LeaveButton(discord.ui.Button):
         if user_id not in r.participants:
             return await interaction.response.send_message("You're not in this rally.", ephemeral=True)
         
-        del r.participants[user_id]
-        await update_post(interaction.guild, r)
+        r.remove_participant(user_id)
         await interaction.response.send_message("You've left the rally.", ephemeral=True)
+        await update_post(interaction.guild, r)
+
+class RallyView(discord.ui.View):
+    # Without a rally this is the persistent template registered in setup_hook
+    def __init__(self, r: Optional[Rally] = None):
+        super().__init__(timeout=None)
+        self.add_item(JoinButton())
+        self.add_item(LeaveButton())
+        if r and r.temp_vc_invite_url:
+            self.add_item(discord.ui.Button(label="Join VC", url=r.temp_vc_invite_url, style=discord.ButtonStyle.link))
 
 class JoinRallyModal(discord.ui.Modal, title="Join Rally"):
     def __init__(self, rally_id: int):
@@ -423,21 +661,20 @@ class JoinRallyModal(discord.ui.Modal, title="Join Rally"):
         self.add_item(self.capacity_value)
 
     async def on_submit(self, interaction: discord.Interaction):
-        r = RALLIES.get(self.rally_id)
+        r = get_rally(self.rally_id)
         if not r:
             return await interaction.response.send_message("Rally not found.", ephemeral=True)
         
         troop = self.troop_type.value.strip().title()
         tier = self.troop_tier.value.strip().upper()
-        dragon = self.rally_dragon.value.strip().lower() in ("yes", "y", "true", "1")
+        dragon = self.rally_dragon.value.strip().lower() in _YES_ANSWERS
         cap = ensure_int(self.capacity_value.value, 0)
         
-        r.participants[interaction.user.id] = Participant(
-            interaction.user.id, troop, tier, dragon, cap
-        )
+        r.add_participant(Participant(interaction.user.id, troop, tier, dragon, cap))
         
-        await update_post(interaction.guild, r)
+        # Answer first so the post edit can't push us past the interaction deadline
         await interaction.response.send_message("You've joined the rally!", ephemeral=True)
+        await update_post(interaction.guild, r)
 
 class KeepForm(discord.ui.Modal, title="Create Keep Rally"):
     keep_power = discord.ui.TextInput(label="Keep Power", placeholder="e.g., 250M", max_length=20)
@@ -453,17 +690,17 @@ class KeepForm(discord.ui.Modal, title="Create Keep Rally"):
 
         if not isinstance(channel, discord.TextChannel):
             return await interaction.response.send_message("Use this in a server text channel.", ephemeral=True)
+        # Creating the VC, invite and post can outlast the 3s window for a first response
+        await interaction.response.defer(ephemeral=True)
 
         try:
             vc = await ensure_temp_vc(guild, author, channel, "Keep Rally", 0)
         except Exception as e:
-            return await interaction.response.send_message(f"Couldn't create temp VC: {e}", ephemeral=True)
+            return await interaction.followup.send(f"Couldn't create temp VC: {e}", ephemeral=True)
 
         invite_url = await create_or_refresh_vc_invite(vc)
-
-        dummy = await channel.send(embed=discord.Embed(title="Creating rally...", color=discord.Color.blurple()))
         r = Rally(
-            message_id=dummy.id,
+            message_id=0,  # filled in once the post exists
             guild_id=guild.id,
             channel_id=channel.id,
             creator_id=author.id,
@@ -476,16 +713,24 @@ class KeepForm(discord.ui.Modal, title="Create Keep Rally"):
             temp_vc_id=vc.id,
             temp_vc_invite_url=invite_url,
         )
-        r.participants[author.id] = Participant(author.id, "Cavalry", "T10", False, 0)
-        RALLIES[dummy.id] = r
-        VC_TO_POST[vc.id] = dummy.id
+        r.add_participant(Participant(author.id, *_DEFAULT_PARTICIPANT_TEMPLATE))
 
-        await dummy.edit(embed=embed_for_rally(guild, r), view=build_rally_view(r))
-        text, mentions = rally_cta_text(guild)
-        await channel.send(text, allowed_mentions=mentions)
+        msg = await channel.send(embed=embed_for_rally(guild, r), view=build_rally_view(r))
+        r.message_id = msg.id
+        r.message_ref = msg
+        track_rally(r, vc)
+        # A fresh VC starts empty and emits no voice event until someone joins, so arm the
+        # grace period here; on_voice_state_update re-arms or cancels the same timer later
+        if vc_is_empty(vc.id):
+            schedule_delete_if_empty(vc)
 
-        await interaction.response.send_message(f"Keep Rally posted in {channel.mention}.", ephemeral=True)
-        asyncio.create_task(schedule_delete_if_empty(guild.id, vc.id))
+        text, mentions = rally_cta_text(guild)
+        # gather is fine for a couple of network-bound calls; larger fan-outs should
+        # create tasks and use asyncio.wait to skip gather's result bookkeeping
+        await asyncio.gather(
+            channel.send(text, allowed_mentions=mentions),
+            interaction.followup.send(f"Keep Rally posted in {channel.mention}.", ephemeral=True),
+        )
 
 # ============================== SLASH COMMANDS ==============================
 rally_group = app_commands.Group(name="rally", description="Create and manage rallies")
@@ -499,17 +744,17 @@ async def rally_sop(interaction: discord.Interaction):
 
     if not isinstance(channel, discord.TextChannel):
         return await interaction.response.send_message("Use this in a server text channel.", ephemeral=True)
+    # Creating the VC, invite and post can outlast the 3s window for a first response
+    await interaction.response.defer(ephemeral=True)
 
     try:
         vc = await ensure_temp_vc(guild, author, channel, "SOP Rally", 0)
     except Exception as e:
-        return await interaction.response.send_message(f"Couldn't create temp VC: {e}", ephemeral=True)
+        return await interaction.followup.send(f"Couldn't create temp VC: {e}", ephemeral=True)
 
     invite_url = await create_or_refresh_vc_invite(vc)
-
-    dummy = await channel.send(embed=discord.Embed(title="Creating rally...", color=discord.Color.blurple()))
     r = Rally(
-        message_id=dummy.id,
+        message_id=0,  # filled in once the post exists
         guild_id=guild.id,
         channel_id=channel.id,
         creator_id=author.id,
@@ -517,16 +762,22 @@ async def rally_sop(interaction: discord.Interaction):
         temp_vc_id=vc.id,
         temp_vc_invite_url=invite_url,
     )
-    r.participants[author.id] = Participant(author.id, "Cavalry", "T10", False, 0)
-    RALLIES[dummy.id] = r
-    VC_TO_POST[vc.id] = dummy.id
+    r.add_participant(Participant(author.id, *_DEFAULT_PARTICIPANT_TEMPLATE))
 
-    await dummy.edit(embed=embed_for_rally(guild, r), view=build_rally_view(r))
-    text, mentions = rally_cta_text(guild)
-    await channel.send(text, allowed_mentions=mentions)
+    msg = await channel.send(embed=embed_for_rally(guild, r), view=build_rally_view(r))
+    r.message_id = msg.id
+    r.message_ref = msg
+    track_rally(r, vc)
+    # A fresh VC starts empty and emits no voice event until someone joins, so arm the
+    # grace period here; on_voice_state_update re-arms or cancels the same timer later
+    if vc_is_empty(vc.id):
+        schedule_delete_if_empty(vc)
 
-    await interaction.response.send_message(f"SOP Rally posted in {channel.mention}.", ephemeral=True)
-    asyncio.create_task(schedule_delete_if_empty(guild.id, vc.id))
+    text, mentions = rally_cta_text(guild)
+    await asyncio.gather(
+        channel.send(text, allowed_mentions=mentions),
+        interaction.followup.send(f"SOP Rally posted in {channel.mention}.", ephemeral=True),
+    )
 
 @rally_group.command(name="keep", description="Create a Keep Rally")
 async def rally_keep(interaction: discord.Interaction):
@@ -554,24 +805,20 @@ async def bomb_rally(interaction: discord.Interaction, duration: str):
     if not member.voice or not isinstance(member.voice.channel, discord.VoiceChannel):
         return await interaction.followup.send("Join a voice channel first!", ephemeral=True)
     
-    voice, err = await _ensure_voice_ready(member)
-    if not voice:
-        return await interaction.followup.send(f"Failed to connect: {err}", ephemeral=True)
-    
-    url_map = {"5m": AUDIO_5M_BOMB, "10m": AUDIO_10M_BOMB, "30m": AUDIO_30M_BOMB, "1h": AUDIO_1H_BOMB}
-    url = url_map.get(duration)
+    url = BOMB_AUDIO.get(duration)
     
     if not url:
         return await interaction.followup.send(f"No audio file configured for {duration}", ephemeral=True)
     
+    voice, source, err = await _connect_with_audio(member, url)
+    if err:
+        return await interaction.followup.send(err, ephemeral=True)
+    
     try:
-        await _play_audio_url(voice, url)
+        await _play_audio(voice, source)
         await interaction.followup.send(f"Played {duration} bomb rally!", ephemeral=True)
         
-        state = VOICE_STATE.setdefault(member.guild.id, GuildVoiceState())
-        if state.disconnect_task and not state.disconnect_task.done():
-            state.disconnect_task.cancel()
-        state.disconnect_task = asyncio.create_task(schedule_disconnect(member.guild.id, DISCONNECT_AFTER_PLAY_SECS))
+        _schedule_auto_disconnect(member.guild.id)
         
     except Exception as e:
         await interaction.followup.send(f"Playback failed: {e}", ephemeral=True)
@@ -594,24 +841,20 @@ async def rolling_rally(interaction: discord.Interaction, gap: str):
     if not member.voice or not isinstance(member.voice.channel, discord.VoiceChannel):
         return await interaction.followup.send("Join a voice channel first!", ephemeral=True)
     
-    voice, err = await _ensure_voice_ready(member)
-    if not voice:
-        return await interaction.followup.send(f"Failed to connect: {err}", ephemeral=True)
-    
-    url_map = {"5s": AUDIO_5S_ROLL, "10s": AUDIO_10S_ROLL, "15s": AUDIO_15S_ROLL, "30s": AUDIO_30S_ROLL}
-    url = url_map.get(gap)
+    url = ROLLING_AUDIO.get(gap)
     
     if not url:
         return await interaction.followup.send(f"No audio file configured for {gap} gap", ephemeral=True)
     
+    voice, source, err = await _connect_with_audio(member, url)
+    if err:
+        return await interaction.followup.send(err, ephemeral=True)
+    
     try:
-        await _play_audio_url(voice, url)
+        await _play_audio(voice, source)
         await interaction.followup.send(f"Played rolling rally with {gap} gaps!", ephemeral=True)
         
-        state = VOICE_STATE.setdefault(member.guild.id, GuildVoiceState())
-        if state.disconnect_task and not state.disconnect_task.done():
-            state.disconnect_task.cancel()
-        state.disconnect_task = asyncio.create_task(schedule_disconnect(member.guild.id, DISCONNECT_AFTER_PLAY_SECS))
+        _schedule_auto_disconnect(member.guild.id)
         
     except Exception as e:
         await interaction.followup.send(f"Playback failed: {e}", ephemeral=True)
@@ -628,7 +871,7 @@ async def stay_command(interaction: discord.Interaction):
     if not voice:
         return await interaction.followup.send(f"Failed to connect: {err}", ephemeral=True)
     
-    state = VOICE_STATE.setdefault(member.guild.id, GuildVoiceState())
+    state = _voice_state(member.guild.id)
     state.stay_mode = True
     if state.disconnect_task and not state.disconnect_task.done():
         state.disconnect_task.cancel()
@@ -651,18 +894,30 @@ async def leave_command(interaction: discord.Interaction):
         await interaction.followup.send("Not connected to voice.", ephemeral=True)
 
 # ============================== VC CLEANUP ==============================
-async def schedule_delete_if_empty(guild_id: int, vc_id: int):
-    await asyncio.sleep(DELETE_VC_IF_EMPTY_AFTER_SECS)
-    guild = bot.get_guild(guild_id)
-    if not guild:
-        return
-    vc = guild.get_channel(vc_id)
-    if isinstance(vc, discord.VoiceChannel) and len(vc.members) == 0:
+# One pending grace-period timer per temp VC; re-arming replaces the previous one
+_VC_DELETE_TIMERS: Dict[int, asyncio.TimerHandle] = {}
+
+def schedule_delete_if_empty(vc: discord.VoiceChannel):
+    cancel_delete_if_empty(vc.id)
+    _VC_DELETE_TIMERS[vc.id] = asyncio.get_running_loop().call_later(
+        DELETE_VC_IF_EMPTY_AFTER_SECS, lambda: _spawn(_delete_if_still_empty(vc))
+    )
+
+def cancel_delete_if_empty(vc_id: int):
+    handle = _VC_DELETE_TIMERS.pop(vc_id, None)
+    if handle:
+        handle.cancel()
+
+async def _delete_if_still_empty(vc: discord.VoiceChannel):
+    _VC_DELETE_TIMERS.pop(vc.id, None)
+    if vc_is_empty(vc.id):
         log.info("Deleting empty VC %s", vc.name)
-        await delete_rally_for_vc(guild, vc, "Empty after grace period")
+        await delete_rally_for_vc(vc.guild, vc, "Empty after grace period")
 
 async def delete_rally_for_vc(guild: discord.Guild, vc: discord.VoiceChannel, reason: str):
-    mid = VC_TO_POST.pop(vc.id, None)
+    cancel_delete_if_empty(vc.id)
+    r = RALLY_BY_VC.pop(vc.id, None)
+    VC_NONBOT_COUNT.pop(vc.id, None)
     try:
         if guild.voice_client and guild.voice_client.channel and guild.voice_client.channel.id == vc.id:
             await guild.voice_client.disconnect()
@@ -673,10 +928,10 @@ async def delete_rally_for_vc(guild: discord.Guild, vc: discord.VoiceChannel, re
     except Exception as e:
         log.warning("Failed to delete VC %s: %s", vc.name, e)
     
-    if mid and mid in RALLIES:
-        r = RALLIES[mid]
+    if r:
         r.temp_vc_id = None
         r.temp_vc_invite_url = None
+        r._view_cache = None
         await update_post(guild, r)
 
 @bot.event
@@ -687,27 +942,99 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
                 del VOICE_STATE[member.guild.id]
         return
 
+    # Mute/deafen/stream toggles fire this event too; nothing below cares about them
+    if before.channel == after.channel:
+        return
+
     if member.guild:
         _reset_activity(member.guild.id)
 
+    before_id = before.channel.id if before.channel else None
+    after_id = after.channel.id if after.channel else None
+    # Most voice events have nothing to do with a rally temp VC
+    if before_id not in RALLY_BY_VC and after_id not in RALLY_BY_VC:
+        return
+
+    if not member.bot:
+        if before_id in VC_NONBOT_COUNT:
+            VC_NONBOT_COUNT[before_id] = max(0, VC_NONBOT_COUNT[before_id] - 1)
+        if after_id in VC_NONBOT_COUNT:
+            VC_NONBOT_COUNT[after_id] += 1
+
     for ch in (before.channel, after.channel):
-        if not isinstance(ch, discord.VoiceChannel) or ch.id not in VC_TO_POST:
+        # Only temp voice channels are ever registered, so the id check doubles as a type check
+        if ch is None or ch.id not in RALLY_BY_VC:
             continue
         
-        if len(ch.members) == 0:
-            asyncio.create_task(schedule_delete_if_empty(ch.guild.id, ch.id))
+        if vc_is_empty(ch.id):
+            schedule_delete_if_empty(ch)
+        else:
+            cancel_delete_if_empty(ch.id)
 
 # ============================== LIFECYCLE ==============================
+@bot.event
+async def setup_hook():
+    # Runs once per process, unlike on_ready which repeats after reconnects
+    # Route Join/Leave clicks on posts from before a restart back to the buttons by custom_id
+    bot.add_view(RallyView())
+    if ENABLE_VOICE:
+        _spawn(prefetch_audio())
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    forget_guild_roles(role.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    forget_guild_roles(role.guild.id)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    if before.name != after.name:
+        forget_guild_roles(after.guild.id)
+    if after.is_default():
+        _BASE_OVERWRITES.pop(after.guild.id, None)
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    forget_guild_roles(guild.id)
+    _BASE_OVERWRITES.pop(guild.id, None)
+
+def _command_tree_hash() -> str:
+    payload = [cmd.to_dict(tree) for cmd in tree.get_commands()]
+    # Include the application so switching bot tokens on the same host still resyncs
+    return hashlib.sha1(json.dumps([bot.application_id, payload, GUILD_IDS], sort_keys=True).encode()).hexdigest()
+
+def _read_sync_hash() -> Optional[str]:
+    try:
+        with open(COMMAND_SYNC_HASH_PATH) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _write_sync_hash(value: str):
+    try:
+        with open(COMMAND_SYNC_HASH_PATH, "w") as f:
+            f.write(value)
+    except OSError as e:
+        log.warning("Could not record command sync hash: %s", e)
+
 @bot.event
 async def on_ready():
     try:
-        guild_ids = _parse_guild_ids()
-        if guild_ids:
-            for gid in guild_ids:
-                await tree.sync(guild=discord.Object(id=gid))
-            log.info("Synced commands to %d guilds", len(guild_ids))
+        cmds_hash = _command_tree_hash()
+        if cmds_hash == _read_sync_hash():
+            log.info("Commands unchanged since last sync, skipping")
+        elif GUILD_IDS:
+            guilds = [discord.Object(id=gid) for gid in GUILD_IDS]
+            for g in guilds:
+                tree.copy_global_to(guild=g)
+            await asyncio.gather(*(tree.sync(guild=g) for g in guilds))
+            _write_sync_hash(cmds_hash)
+            log.info("Synced commands to %d guilds", len(GUILD_IDS))
         else:
             await tree.sync()
+            _write_sync_hash(cmds_hash)
             log.info("Synced commands globally")
     except Exception as e:
         log.exception("Failed to sync commands: %s", e)
@@ -719,6 +1046,9 @@ if __name__ == "__main__":
     # Start health check server in background thread
     health_thread = Thread(target=run_health_server, args=(HEALTH_PORT,), daemon=True)
     health_thread.start()
+    if uvloop is not None:
+        # Must be set before bot.run() creates its event loop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     log.info("Starting bot...")
     
     bot.run(TOKEN)